@@ -34,4 +34,14 @@ class Config:
     CHAT_MEMORY_TOKEN_LIMIT = 2000
     GROUNDING_MAX_OUTPUT_TOKENS = 3000
     GROUNDING_LAST_N_MESSAGES = -6
-    CHAT_HISTORY_TOKEN_RATIO = 1.0
\ No newline at end of file
+    CHAT_HISTORY_TOKEN_RATIO = 1.0
+    
+    SESSION_CACHE_MAX_SESSIONS = 1000
+    SESSION_CACHE_IDLE_TTL = 900 # in seconds (keep it below REDIS_TTL)
+    SESSION_CACHE_CHANNEL = "chat_session_invalidation"
+    
+    BATCH_CONCURRENCY = 4
+    BATCH_RATE_LIMIT = 2.0 # in workflow runs started per second (0 disables the limit)
+    BATCH_USER_NAME = "Evaluator"
+    BATCH_USER_ID = "batch_runner"
+    BATCH_WORKFLOW_TIMEOUT = 120 # in seconds
\ No newline at end of file
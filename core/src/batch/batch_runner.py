@@ -0,0 +1,209 @@
+# Batch mode of the RAG system: push a JSONL file of questions (course FAQs, regression
+# eval sets) through the RagChatWorkflow with bounded concurrency and a rate limit.
+# Per-user chat memory is never touched and the output file doubles as a checkpoint,
+# so an interrupted run picks up where it stopped.
+#
+# Input lines:  {"id": "q1", "question": "...", "user_name": "..."}  ("id" and "user_name" are optional)
+# Output lines: {"id": "q1", "question": "...", "answer": "...", "relevant_node_ids": [...],
+#                "stage_latency": {...}, "token_usage": {...}}
+#
+# Usage: uv run -m core.src.batch.batch_runner questions.jsonl answers.jsonl --concurrency 8 --rate-limit 4
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from core.config.config import Config
+from core.src.rag.rag_workflow import RagChatWorkflow
+
+from helpers.logger import logger
+
+
+class RateLimiter:
+    # Spaces out the start of workflow runs so that no more than `rate` runs start per second
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RagBatchRunner:
+    # Streams questions from the input JSONL file through the workflow and appends the
+    # results to the output JSONL file, one line per answered question
+    
+    def __init__(
+        self,
+        workflow: RagChatWorkflow,
+        concurrency: int = Config.BATCH_CONCURRENCY,
+        rate_limit: float = Config.BATCH_RATE_LIMIT
+    ):
+        self.workflow = workflow
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.write_lock = asyncio.Lock()
+
+    # --------------------------------------------------------------------------------
+    # Helper method to collect the ids that were already answered in a previous run
+    def load_checkpoint(self, output_path: Path) -> set[str]:
+        done_ids = set()
+        if not output_path.exists():
+            return done_ids
+
+        with open(output_path, "r", encoding = "utf-8") as file:
+            for line in file:
+                try:
+                    done_ids.add(str(json.loads(line)["id"]))
+                except (json.JSONDecodeError, KeyError):
+                    # A half-written last line from an interrupted run; the question is simply asked again
+                    continue
+        return done_ids
+    
+    # Helper method to cut off a half-written last line so that new answers start on a fresh line
+    def repair_checkpoint(self, output_path: Path) -> None:
+        if not output_path.exists():
+            return
+
+        with open(output_path, "rb+") as file:
+            content = file.read()
+            if not content or content.endswith(b"\n"):
+                return
+            
+            file.truncate(content.rfind(b"\n") + 1)
+            logger.warning(f"Removed a half-written last line from {output_path}")
+    
+    # Helper method to lazily read the questions so that large files are never loaded at once
+    def read_questions(self, input_path: Path):
+        with open(input_path, "r", encoding = "utf-8") as file:
+            for line_number, line in enumerate(file, start = 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Skipping line {line_number} of {input_path}: {e}")
+                    continue
+                
+                if not record.get("question"):
+                    logger.warning(f"Skipping line {line_number} of {input_path}: no question found")
+                    continue
+                
+                record["id"] = str(record.get("id", line_number))
+                yield record
+    # --------------------------------------------------------------------------------
+
+    async def answer(self, record: dict) -> dict:
+        await self.rate_limiter.acquire()
+        
+        result = await self.workflow.run(
+            user_query = record["question"],
+            user_name = record.get("user_name") or Config.BATCH_USER_NAME,
+            user_id = Config.BATCH_USER_ID,
+            persist_memory = False,
+            return_details = True
+        )
+        
+        # The workflow stops without a result when the start event is incomplete
+        if not isinstance(result, dict):
+            raise ValueError(f"Workflow returned no detailed result: {result!r}")
+
+        return {"id": record["id"], "question": record["question"], **result}
+
+    async def worker(self, queue: asyncio.Queue, output_file, stats: dict):
+        while True:
+            record = await queue.get()
+            try:
+                if record is None:
+                    return
+
+                try:
+                    output = await self.answer(record)
+                except Exception as e:
+                    # Failed questions are not checkpointed, so the next run retries them
+                    logger.error(f"Question {record['id']} failed: {e}")
+                    stats["failed"] += 1
+                    continue
+
+                # Write errors (disk full, I/O errors) are not caught: they abort the whole run
+                async with self.write_lock:
+                    output_file.write(json.dumps(output, ensure_ascii = False) + "\n")
+                    output_file.flush()
+                stats["answered"] += 1
+            finally:
+                queue.task_done()
+
+    async def produce(self, queue: asyncio.Queue, input_path: Path, done_ids: set[str], stats: dict):
+        for record in self.read_questions(input_path):
+            if record["id"] in done_ids:
+                stats["skipped"] += 1
+                continue
+            await queue.put(record)
+
+        for _ in range(self.concurrency):
+            await queue.put(None)
+
+    async def run(self, input_path: Path, output_path: Path) -> dict:
+        done_ids = self.load_checkpoint(output_path)
+        if done_ids:
+            logger.info(f"Resuming batch run: {len(done_ids)} questions already answered in {output_path}")
+        self.repair_checkpoint(output_path)
+
+        stats = {"answered": 0, "failed": 0, "skipped": 0}
+        # A bounded queue keeps the reader only a few questions ahead of the workers
+        queue = asyncio.Queue(maxsize = self.concurrency * 2)
+
+        with open(output_path, "a", encoding = "utf-8") as output_file:
+            tasks = [asyncio.create_task(self.produce(queue, input_path, done_ids, stats))] + [
+                asyncio.create_task(self.worker(queue, output_file, stats))
+                for _ in range(self.concurrency)
+            ]
+            
+            # The reader runs alongside the workers, so a failing worker cannot leave it blocked on a full queue
+            done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions = True)
+            
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+
+        logger.info(
+            f"Batch run finished: {stats['answered']} answered, {stats['failed']} failed, "
+            f"{stats['skipped']} skipped from checkpoint"
+        )
+        return stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description = "Run a JSONL file of questions through the RAG workflow.")
+    parser.add_argument("input", type = Path, help = "JSONL file with one {\"id\", \"question\"} object per line")
+    parser.add_argument("output", type = Path, help = "JSONL file to append the answers to; also used as the checkpoint")
+    parser.add_argument("--concurrency", type = int, default = Config.BATCH_CONCURRENCY)
+    parser.add_argument("--rate-limit", type = float, default = Config.BATCH_RATE_LIMIT,
+                        help = "workflow runs started per second, 0 disables the limit")
+    args = parser.parse_args()
+
+    runner = RagBatchRunner(
+        workflow = RagChatWorkflow(timeout = Config.BATCH_WORKFLOW_TIMEOUT),
+        concurrency = args.concurrency,
+        rate_limit = args.rate_limit
+    )
+    await runner.run(args.input, args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,326 @@
+# In-process cache of per-user chat sessions, so that users sending several messages
+# in a row skip rebuilding the ChatMemoryBuffer / chat engine and re-reading their
+# history from Redis on every turn.
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, List
+
+import redis.asyncio as async_redis
+from pydantic import Field
+
+from core.config.config import Config
+from core.config.constants import RagConstants
+from core.src.rag.custom_chat_engine import CustomSimpleChatEngine
+
+from helpers.logger import logger
+
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.llms import LLM
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.storage.chat_store import BaseChatStore, SimpleChatStore
+from llama_index.core.utils import get_tokenizer
+
+
+class WriteThroughChatStore(SimpleChatStore):
+    # Keeps an in-process copy of the recent history and writes every change through
+    # to the shared (Redis) chat store. The local copy holds as many of the latest
+    # messages as the memory could ever use (token_limit), so the chat model gets the
+    # same history as when the memory reads from Redis directly.
+    # Redis is written first, so a failed write never leaves the local copy ahead of it.
+
+    remote_store: BaseChatStore
+    token_limit: int = Config.CHAT_MEMORY_TOKEN_LIMIT
+    tokenizer_fn: Callable[[str], List] = Field(default_factory = get_tokenizer, exclude = True)
+    # Number of oldest messages per key that are only kept in the remote store
+    trimmed: Dict[str, int] = Field(default_factory = dict)
+
+    # --------------------------------------------------------------------------------
+    # Helper method to drop the messages that no longer fit into the memory token limit
+    def _trim(self, key: str) -> None:
+        messages = self.store.get(key, [])
+        start = len(messages)
+        token_count = 0
+        while start > 0 and token_count <= self.token_limit:
+            start -= 1
+            token_count += len(self.tokenizer_fn(str(messages[start].content or "")))
+        # One extra message as a margin for tokenizing messages one by one instead of joined
+        start = max(start - 1, 0)
+
+        if start:
+            self.store[key] = messages[start:]
+            self.trimmed[key] = self.trimmed.get(key, 0) + start
+
+    # Helper method to translate an index into the local copy to the same message in the remote store
+    def _remote_idx(self, key: str, idx: int) -> int:
+        # Negative indexes count from the end, where both stores hold the same messages
+        return idx if idx < 0 else idx + self.trimmed.get(key, 0)
+    # --------------------------------------------------------------------------------
+
+    def load_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        # Fill the local copy from the remote store without writing anything back
+        self.store[key] = list(messages)
+        self.trimmed[key] = 0
+        self._trim(key)
+
+    def set_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        self.remote_store.set_messages(key, messages)
+        self.load_messages(key, messages)
+
+    async def aset_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        await self.remote_store.aset_messages(key, messages)
+        self.load_messages(key, messages)
+
+    def add_message(self, key: str, message: ChatMessage, idx: Optional[int] = None) -> None:
+        remote_idx = None if idx is None else self._remote_idx(key, idx)
+        self.remote_store.add_message(key, message, remote_idx)
+        super().add_message(key, message, idx)
+        self._trim(key)
+
+    async def async_add_message(self, key: str, message: ChatMessage, idx: Optional[int] = None) -> None:
+        remote_idx = None if idx is None else self._remote_idx(key, idx)
+        await self.remote_store.async_add_message(key, message, remote_idx)
+        super().add_message(key, message, idx)
+        self._trim(key)
+
+    def delete_messages(self, key: str) -> Optional[List[ChatMessage]]:
+        deleted = self.remote_store.delete_messages(key)
+        super().delete_messages(key)
+        self.trimmed.pop(key, None)
+        return deleted
+
+    async def adelete_messages(self, key: str) -> Optional[List[ChatMessage]]:
+        deleted = await self.remote_store.adelete_messages(key)
+        super().delete_messages(key)
+        self.trimmed.pop(key, None)
+        return deleted
+
+    def delete_message(self, key: str, idx: int) -> Optional[ChatMessage]:
+        deleted = self.remote_store.delete_message(key, self._remote_idx(key, idx))
+        super().delete_message(key, idx)
+        return deleted
+
+    async def adelete_message(self, key: str, idx: int) -> Optional[ChatMessage]:
+        deleted = await self.remote_store.adelete_message(key, self._remote_idx(key, idx))
+        super().delete_message(key, idx)
+        return deleted
+
+    def delete_last_message(self, key: str) -> Optional[ChatMessage]:
+        deleted = self.remote_store.delete_last_message(key)
+        super().delete_last_message(key)
+        return deleted
+
+    async def adelete_last_message(self, key: str) -> Optional[ChatMessage]:
+        deleted = await self.remote_store.adelete_last_message(key)
+        super().delete_last_message(key)
+        return deleted
+
+
+@dataclass
+class ChatSession:
+    chat_engine: CustomSimpleChatEngine
+    memory: ChatMemoryBuffer
+    chat_store: WriteThroughChatStore
+    last_used: float = field(default_factory = time.monotonic)
+
+    def history_bytes(self) -> int:
+        return sum(
+            len(str(message.content or "").encode("utf-8"))
+            for messages in self.chat_store.store.values()
+            for message in messages
+        )
+
+
+class ChatSessionCache:
+    # Bounded LRU cache of chat sessions keyed by user_id with idle-time eviction.
+    # Workers sharing the same Redis announce history writes on a pub/sub channel so
+    # that the other workers drop their (now stale) copy of that user's session.
+
+    def __init__(
+        self,
+        chat_store: BaseChatStore,
+        redis_client: async_redis.Redis,
+        llm: LLM,
+        max_sessions: int = Config.SESSION_CACHE_MAX_SESSIONS,
+        idle_ttl: float = Config.SESSION_CACHE_IDLE_TTL
+    ):
+        self.chat_store = chat_store
+        self.redis_client = redis_client
+        self.llm = llm
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+
+        # Kept in recency order: the least recently used session comes first
+        self.sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        # Sessions being built, shared by concurrent turns of the same user
+        self.pending: dict[str, asyncio.Task] = {}
+        self.worker_id = uuid.uuid4().hex
+        self.listener_task: asyncio.Task | None = None
+        self.listener_lock = asyncio.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # --------------------------------------------------------------------------------
+    # Helper method to build a new session, reading the user's history from Redis once
+    async def build_session(self, user_id: str) -> ChatSession:
+        chat_store_key = f"user_{user_id}"
+        history = await self.chat_store.aget_messages(chat_store_key)
+
+        local_store = WriteThroughChatStore(remote_store = self.chat_store)
+        local_store.load_messages(chat_store_key, history)
+
+        memory = ChatMemoryBuffer.from_defaults(
+            token_limit = Config.CHAT_MEMORY_TOKEN_LIMIT,
+            chat_store = local_store,
+            chat_store_key = chat_store_key,
+            llm = self.llm
+        )
+
+        chat_engine = CustomSimpleChatEngine.from_defaults(
+            llm = self.llm,
+            memory = memory,
+            system_prompt = RagConstants.SYSTEM_PROMPT_WORKFLOW
+        )
+        return ChatSession(chat_engine = chat_engine, memory = memory, chat_store = local_store)
+
+    # Helper method to build a session once and put it into the cache
+    async def load_session(self, user_id: str) -> ChatSession:
+        this_task = asyncio.current_task()
+        try:
+            session = await self.build_session(user_id)
+            # An invalidation during the build drops the pending entry: the session then
+            # serves the waiting turns but is not cached
+            if self.pending.get(user_id) is this_task:
+                self.sessions[user_id] = session
+                self.evict()
+            return session
+        finally:
+            if self.pending.get(user_id) is this_task:
+                del self.pending[user_id]
+
+    # Helper method to drop idle sessions and keep the cache within max_sessions
+    def evict(self) -> None:
+        now = time.monotonic()
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if now - oldest.last_used <= self.idle_ttl:
+                break
+            self.sessions.popitem(last = False)
+            self.evictions += 1
+
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last = False)
+            self.evictions += 1
+    # --------------------------------------------------------------------------------
+
+    async def aget_engine(self, user_id: str) -> CustomSimpleChatEngine:
+        if not await self.astart_listener():
+            # Without invalidations a cached session could serve stale history
+            self.misses += 1
+            session = await self.build_session(user_id)
+            return session.chat_engine
+
+        self.evict()
+
+        session = self.sessions.get(user_id)
+        if session:
+            self.hits += 1
+            self.sessions.move_to_end(user_id)
+        else:
+            load = self.pending.get(user_id)
+            if load:
+                # Another turn of this user is already building the session
+                self.hits += 1
+            else:
+                self.misses += 1
+                load = asyncio.create_task(self.load_session(user_id))
+                self.pending[user_id] = load
+            # Shielded so that a cancelled turn does not cancel the build shared with other turns
+            session = await asyncio.shield(load)
+
+        session.last_used = time.monotonic()
+        return session.chat_engine
+
+    def invalidate(self, user_id: str) -> None:
+        self.pending.pop(user_id, None)
+        if self.sessions.pop(user_id, None):
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self.pending.clear()
+        self.sessions.clear()
+
+    async def apublish_update(self, user_id: str) -> None:
+        # Tell the other workers that this user's history changed
+        payload = json.dumps({"worker_id": self.worker_id, "user_id": user_id})
+        try:
+            await self.redis_client.publish(Config.SESSION_CACHE_CHANNEL, payload)
+        except Exception as e:
+            logger.warning(f"Could not publish session invalidation for user {user_id}: {e}")
+
+    async def astart_listener(self) -> bool:
+        # The listener has to live in the event loop that serves the chat, so it is started
+        # on the first request and restarted if it dies. Returns False if it is not running.
+        if self.listener_task and not self.listener_task.done():
+            return True
+
+        async with self.listener_lock:
+            if self.listener_task and not self.listener_task.done():
+                return True
+
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe(Config.SESSION_CACHE_CHANNEL)
+                # Redis drops messages published before the subscription is live, so wait for the confirmation
+                confirmation = await pubsub.get_message(timeout = Config.REDIS_TIMEOUT)
+                if not confirmation or confirmation["type"] != "subscribe":
+                    raise ConnectionError("subscription was not confirmed")
+            except Exception as e:
+                logger.warning(f"Could not subscribe to session invalidations, sessions are not cached: {e}")
+                await pubsub.aclose()
+                return False
+
+            # Sessions cached before this subscription may have missed invalidations
+            self.clear()
+            self.listener_task = asyncio.create_task(self.listen(pubsub))
+            return True
+
+    async def listen(self, pubsub) -> None:
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+
+                try:
+                    payload = json.loads(message["data"])
+                    worker_id, user_id = payload["worker_id"], payload["user_id"]
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    logger.warning(f"Ignoring malformed session invalidation message: {e}")
+                    continue
+
+                if worker_id != self.worker_id:
+                    self.invalidate(user_id)
+        except Exception as e:
+            logger.error(f"Session invalidation listener stopped: {e}")
+        finally:
+            # Without the listener, cached sessions could miss writes from other workers
+            self.clear()
+            await pubsub.aclose()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "sessions": len(self.sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "history_bytes": sum(session.history_bytes() for session in self.sessions.values())
+        }
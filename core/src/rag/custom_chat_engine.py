@@ -4,6 +4,8 @@ from llama_index.core.agent import AgentChatResponse
 from llama_index.core.base.llms.types import ChatMessage
 from llama_index.core.callbacks import trace_method
 
+from helpers.token_usage import extract_token_usage
+
 from typing import Optional, List
 
 
@@ -54,7 +56,10 @@ class CustomSimpleChatEngine(SimpleChatEngine):
         await self._memory.aput(ChatMessage(content=message, role="user"))
         await self._memory.aput(ai_message)
 
-        return AgentChatResponse(response=str(chat_response.message.content))
+        return AgentChatResponse(
+            response=str(chat_response.message.content),
+            metadata={"token_usage": extract_token_usage(chat_response.raw)}
+        )
     
     @property
     def memory(self) -> Memory:
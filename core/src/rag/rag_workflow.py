@@ -4,13 +4,16 @@ from core.config.config import Config
 from core.config.constants import RagConstants
 from core.config.llm_setup import LLMsetups
 from core.src.rag.custom_chat_engine import CustomSimpleChatEngine
+from core.src.rag.chat_session_cache import ChatSessionCache
 from core.src.rag.rag_ingestion import RagIngestion
 from core.config.constants import RagConstants
 from core.src.rag.rag_events import RetrievalRelevantEvent
 
 from helpers.logger import logger
 from helpers.json_extractor import extract_json_array
+from helpers.token_usage import extract_token_usage
 
+import time
 import redis
 import redis.asyncio as async_redis
 
@@ -30,8 +33,12 @@ from llama_index.core.workflow import (
 class RagChatWorkflow(Workflow):
     # This is the whole RAG system implemented as a Workflow
     
-    def __init__(self):
-        super().__init__()
+    def __init__(self, timeout: float | None = None):
+        # Keep the Workflow default timeout unless a caller (e.g. the batch runner) sets one
+        if timeout is None:
+            super().__init__()
+        else:
+            super().__init__(timeout = timeout)
         self.token_counter = TokenCountingHandler()
         
         if Settings.callback_manager:
@@ -46,6 +53,11 @@ class RagChatWorkflow(Workflow):
         self.chat_llm.callback_manager = Settings.callback_manager
         
         self.redis_chat_store = self.redis_chat_store_init()
+        self.chat_sessions = ChatSessionCache(
+            chat_store = self.redis_chat_store,
+            redis_client = self.redis_async_client,
+            llm = self.chat_llm
+        )
         self.router_retriever = RagIngestion().ingest()
     
     # --------------------------------------------------------------------------------
@@ -60,6 +72,8 @@ class RagChatWorkflow(Workflow):
         )
 
         custom_async_client = async_redis.Redis(connection_pool = async_pool)
+        # Also used by the session cache to broadcast invalidations to other workers
+        self.redis_async_client = custom_async_client
 
         # For llama_index
         sync_pool = redis.ConnectionPool.from_url(
@@ -88,6 +102,10 @@ class RagChatWorkflow(Workflow):
         user_query = ev.get("user_query")
         user_name = ev.get("user_name")
         user_id = ev.get("user_id")
+        # Batch runs (evaluation, pre-warming) do not touch the per-user chat history
+        # and ask for the detailed result instead of the plain answer string
+        persist_memory = ev.get("persist_memory", True)
+        return_details = ev.get("return_details", False)
         
         if not user_query or not self.router_retriever or not user_name or not user_id:
             logger.warning("Relevancy check cannot be performed, missing arguments in the Start Event.")
@@ -98,13 +116,20 @@ class RagChatWorkflow(Workflow):
             await ctx.store.set("user_name", user_name)
         if user_id:
             await ctx.store.set("user_id", user_id)
+        await ctx.store.set("persist_memory", persist_memory)
+        await ctx.store.set("return_details", return_details)
         
+        await ctx.store.set("relevant_node_ids", [])
+        await ctx.store.set("token_usage", {})
         
+        start_time = time.perf_counter()
         try:
             retrieved_nodes = await self.router_retriever.aretrieve(user_query)
         except ValueError as e:
             logger.warning(f"{e}: knowledge base does not contain relevant info; no nodes were retrieved")
+            await ctx.store.set("stage_latency", {"retrieval": time.perf_counter() - start_time})
             return RetrievalRelevantEvent(context = False)
+        stage_latency = {"retrieval": time.perf_counter() - start_time}
         
         # Create retrieved_nodes str for LLM to easier make a choice
         retrieved_nodes_str = ""
@@ -121,7 +146,11 @@ class RagChatWorkflow(Workflow):
             context = retrieved_nodes_str
         )
         # Make an LLM call to get relevant nodes
+        start_time = time.perf_counter()
         response_relevance = await self.router_llm.acomplete(relevance_check_prompt)
+        stage_latency["relevance_check"] = time.perf_counter() - start_time
+        await ctx.store.set("stage_latency", stage_latency)
+        await ctx.store.set("token_usage", {"relevance_check": extract_token_usage(response_relevance.raw)})
         
         # Now, we derive the relevant context from the LLM response and construct the final
         # context string that we will later use in the final LLM call to generate an answer to the user query
@@ -133,6 +162,8 @@ class RagChatWorkflow(Workflow):
             logger.warning("Among retrieved nodes, no nodes contain relevant information to the user's query.")
             return RetrievalRelevantEvent(context = False)
         
+        await ctx.store.set("relevant_node_ids", relevant_node_ids)
+        
         # if not relevant_node_ids:
         #     logger.warning("Retrieved nodes do not containt a relevant info.")
         # else:
@@ -151,24 +182,54 @@ class RagChatWorkflow(Workflow):
         user_query = await ctx.store.get("user_query", default = None)
         user_name = await ctx.store.get("user_name", default = None)
         user_id = await ctx.store.get("user_id", default = None)
+        persist_memory = await ctx.store.get("persist_memory", default = True)
+        return_details = await ctx.store.get("return_details", default = False)
         
         context = ev.context
         
         if not context:
             logger.warning("No context is provided.")
 
-        memory = ChatMemoryBuffer.from_defaults(
-            token_limit = Config.CHAT_MEMORY_TOKEN_LIMIT,
-            chat_store = self.redis_chat_store,            
-            chat_store_key = f"user_{user_id}",
-            llm = self.chat_llm             
-        )
-
-        chat_engine = CustomSimpleChatEngine.from_defaults(
-            llm = self.chat_llm,           
-            memory = memory,               
-            system_prompt = RagConstants.SYSTEM_PROMPT_WORKFLOW  
-        )
+        if persist_memory:
+            # The engine and memory of returning users are reused from the session cache;
+            # history writes go through to Redis
+            chat_engine = await self.chat_sessions.aget_engine(user_id)
+        else:
+            # Throwaway in-process memory: no history is read from or written to Redis
+            memory = ChatMemoryBuffer.from_defaults(
+                token_limit = Config.CHAT_MEMORY_TOKEN_LIMIT,
+                llm = self.chat_llm
+            )
+
+            chat_engine = CustomSimpleChatEngine.from_defaults(
+                llm = self.chat_llm,           
+                memory = memory,               
+                system_prompt = RagConstants.SYSTEM_PROMPT_WORKFLOW  
+            )
+        
+        start_time = time.perf_counter()
+        try:
+            response = await chat_engine.achat(user_query, user_name, context)
+        except Exception:
+            # A failed turn may have written only part of the history; rebuild the session from Redis next time
+            if persist_memory:
+                self.chat_sessions.invalidate(user_id)
+            raise
+        
+        if persist_memory:
+            await self.chat_sessions.apublish_update(user_id)
+        
+        if not return_details:
+            return StopEvent(result = response.response)
+        
+        stage_latency = await ctx.store.get("stage_latency", default = {})
+        token_usage = await ctx.store.get("token_usage", default = {})
+        stage_latency["synthesis"] = time.perf_counter() - start_time
+        token_usage["synthesis"] = (response.metadata or {}).get("token_usage", {})
         
-        response = await chat_engine.achat(user_query, user_name, context)
-        return StopEvent(result = response.response)
\ No newline at end of file
+        return StopEvent(result = {
+            "answer": response.response,
+            "relevant_node_ids": await ctx.store.get("relevant_node_ids", default = []),
+            "stage_latency": stage_latency,
+            "token_usage": token_usage
+        })
\ No newline at end of file
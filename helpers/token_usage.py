@@ -0,0 +1,18 @@
+# Define function to read the token counts reported by the LLM provider.
+# Gemini responses carry them in the raw 'usage_metadata' payload; we read them per call
+# because the shared TokenCountingHandler mixes up counts of concurrent workflow runs.
+def extract_token_usage(raw) -> dict:
+    usage = {}
+    if isinstance(raw, dict):
+        usage = raw.get("usage_metadata") or {}
+    elif raw is not None:
+        usage = getattr(raw, "usage_metadata", None) or {}
+
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else {}
+
+    return {
+        "prompt_tokens": usage.get("prompt_token_count") or 0,
+        "completion_tokens": usage.get("candidates_token_count") or 0,
+        "total_tokens": usage.get("total_token_count") or 0
+    }